@@ -1,9 +1,15 @@
 import argparse
+import array
 import asyncio
+import base64
+import contextlib
+import csv
 import datetime
+import hashlib
 import importlib
 import inspect
 import itertools
+import heapq
 import json
 import logging
 import os
@@ -11,13 +17,27 @@ import pkgutil
 import re
 import sqlite3
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import time
+import urllib.parse
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 version_info = (0, 4, 0)
 version = ".".join(str(v) for v in version_info)
 
 logger = logging.getLogger(__name__)
 
+PREFETCH_BATCH_SIZE = 500
+SEARCH_TAGS = ("<b>", "</b>")
+REBUILD_BATCH_SIZE = 10000
+PARALLEL_CHUNK_ROWS = 10000
+LOAD_BATCH_SIZE = 10000
+
 
 class DatabaseError(Exception):
     pass
@@ -40,6 +60,45 @@ def lower(text):
     return str(text).strip().lower() if text is not None else None
 
 
+def identity(value):
+    return value
+
+
+@contextlib.contextmanager
+def atomic(connection, name="dorm"):
+    # A savepoint works whether or not the connection is already in a transaction.
+    connection.execute("SAVEPOINT {}".format(name))
+    try:
+        yield connection
+    except BaseException:
+        if connection.in_transaction:
+            connection.execute("ROLLBACK TO {}".format(name))
+            connection.execute("RELEASE {}".format(name))
+        raise
+    else:
+        connection.execute("RELEASE {}".format(name))
+
+
+def schema_sql(connection, table_name, types=("index", "trigger")):
+    # The (name, sql) of user-created indexes and triggers for a table, i.e. the things that need to be recreated.
+    return connection.execute(
+        "SELECT name, sql FROM sqlite_master WHERE tbl_name = ? AND type IN ({}) AND sql IS NOT NULL".format(
+            ", ".join("?" for _ in types)
+        ),
+        [table_name] + list(types),
+    ).fetchall()
+
+
+def typecode(sql_type):
+    # The array.array typecode for a column type (following SQLite's affinity rules), or None for non-numeric types.
+    sql_type = sql_type.lower()
+    if "int" in sql_type or sql_type.startswith("bool"):
+        return "q"
+    if "real" in sql_type or "floa" in sql_type or "doub" in sql_type:
+        return "d"
+    return None
+
+
 class Column:
     def __init__(
         self,
@@ -50,24 +109,33 @@ class Column:
         default=None,
         to_python=None,
         to_sql=None,
+        index=False,
+        searchable=False,
     ):
         self.sql_type = sql_type
         self.unique = unique
         self.null = null
         self.primary_key = primary_key
         self.default = default
-        self.to_python = to_python or (lambda value: value)
-        self.to_sql = to_sql or (lambda value: value)
+        self.to_python = to_python or identity
+        self.to_sql = to_sql or identity
+        self.index = index
+        self.searchable = searchable
 
-    def __call__(self, **kwargs):
-        new_kwargs = {
+    def options(self):
+        return {
             "unique": self.unique,
             "null": self.null,
             "primary_key": self.primary_key,
             "default": self.default,
             "to_python": self.to_python,
             "to_sql": self.to_sql,
+            "index": self.index,
+            "searchable": self.searchable,
         }
+
+    def __call__(self, **kwargs):
+        new_kwargs = self.options()
         new_kwargs.update(kwargs)
         return self.__class__(self.sql_type, **new_kwargs)
 
@@ -88,6 +156,38 @@ class Column:
             sql += " DEFAULT {}".format(d)
         return sql
 
+    def index_sql(self, table_name, name):
+        if self.index and not self.primary_key and not self.unique:
+            return "CREATE INDEX {0}_{1}_idx ON {0} ({1})".format(table_name, name)
+        return None
+
+
+def related_pk(value):
+    return value.pk if isinstance(value, BaseTable) else value
+
+
+class ForeignKey(Column):
+    def __init__(self, table, **kwargs):
+        kwargs.setdefault("to_sql", related_pk)
+        kwargs.setdefault("index", True)
+        super().__init__("integer", **kwargs)
+        self.table = table
+
+    def __call__(self, **kwargs):
+        new_kwargs = self.options()
+        new_kwargs.update(kwargs)
+        return self.__class__(self.table, **new_kwargs)
+
+    def typedef(self, name):
+        # The related table may not be bound yet, so figure out its name and primary key the same way bind will.
+        table_name = self.table.__table__ or snake(self.table.__name__)
+        for pk_name, col in self.table.columns.items():
+            if col.primary_key:
+                return "{} REFERENCES {}({})".format(
+                    super().typedef(name), table_name, pk_name
+                )
+        return "{} REFERENCES {}".format(super().typedef(name), table_name)
+
 
 PK = Column("integer", primary_key=True)
 String = Column("text", null=False, default="''")
@@ -108,14 +208,26 @@ class BaseQuery:
         self._filters = {}
         self._order = []
         self._limit = None
+        self._prefetch = []
+        self._search = None
 
-    def copy(self, filters=None, order=None, limit=None, fields=None):
+    def copy(
+        self,
+        filters=None,
+        order=None,
+        limit=None,
+        fields=None,
+        prefetch=None,
+        search=None,
+    ):
         other = self.__class__(self.table)
         other._filters = self._filters.copy()
         if filters:
             other._filters.update(filters)
         other._order = order if order is not None else self._order[:]
         other._limit = limit if limit is not None else self._limit
+        other._prefetch = self._prefetch + list(prefetch or [])
+        other._search = search if search is not None else self._search
         return other
 
     def filter(self, **kwargs):
@@ -130,16 +242,99 @@ class BaseQuery:
     def limit(self, limit):
         return self.copy(limit=limit)
 
-    def to_sql(self, selects=None):
+    def prefetch(self, *fields):
+        for field in fields:
+            if not isinstance(self.table.columns.get(field), ForeignKey):
+                raise DatabaseError(
+                    '"{}" is not a ForeignKey of {}.'.format(field, self.table.__name__)
+                )
+        return self.copy(prefetch=fields)
+
+    def search(self, terms, highlight=None, snippet=None, tags=SEARCH_TAGS, tokens=16):
+        searchable = self.table.searchable()
+        if not searchable:
+            raise DatabaseError(
+                "{} has no searchable columns.".format(self.table.__name__)
+            )
+        highlight = [highlight] if isinstance(highlight, str) else list(highlight or [])
+        snippet = [snippet] if isinstance(snippet, str) else list(snippet or [])
+        for name in highlight + snippet:
+            if name not in searchable:
+                raise DatabaseError(
+                    '"{}" is not a searchable column of {}.'.format(
+                        name, self.table.__name__
+                    )
+                )
+        return self.copy(
+            search={
+                "terms": terms,
+                "highlight": highlight,
+                "snippet": snippet,
+                "tags": tags,
+                "tokens": tokens,
+            }
+        )
+
+    def selects(self, fields=None):
+        if fields:
+            return list(fields)
+        selects = list(self.table.columns.keys())
+        if self.table.__pk__ not in selects:
+            selects.insert(0, self.table.__pk__)
+        if self._search:
+            selects.append("search_rank")
+            selects.extend(name + "_highlight" for name in self._search["highlight"])
+            selects.extend(name + "_snippet" for name in self._search["snippet"])
+        return selects
+
+    def _search_sql(self):
+        # Searching joins the table to the matching rows of its FTS index, along with their rank, highlights, and
+        # snippets. Column aliases are distinct from table column names, so only rowid is ambiguous.
+        table = self.table.__table__
+        fts = "{}_fts".format(table)
+        searchable = self.table.searchable()
+        open_tag, close_tag = self._search["tags"]
+        columns = ["rowid AS search_rowid", "bm25({}) AS search_rank".format(fts)]
+        params = []
+        for name in self._search["highlight"]:
+            columns.append(
+                "highlight({}, {}, ?, ?) AS {}_highlight".format(
+                    fts, searchable.index(name), name
+                )
+            )
+            params.extend([open_tag, close_tag])
+        for name in self._search["snippet"]:
+            columns.append(
+                "snippet({}, {}, ?, ?, ?, ?) AS {}_snippet".format(
+                    fts, searchable.index(name), name
+                )
+            )
+            params.extend([open_tag, close_tag, "...", self._search["tokens"]])
+        params.append(self._search["terms"])
+        source = "{} JOIN (SELECT {} FROM {} WHERE {} MATCH ?) ON search_rowid = {}.{}".format(
+            table, ", ".join(columns), fts, fts, table, self.table.__pk__
+        )
+        return source, params
+
+    def _column(self, field):
+        if self._search and field == "rowid":
+            return "{}.rowid".format(self.table.__table__)
+        return field
+
+    def to_sql(self, selects=None, extra=None):
         if selects is None:
-            selects = list(self.table.columns.keys())
-            if self.table.__pk__ not in selects:
-                selects.insert(0, self.table.__pk__)
-        sql = "SELECT {} FROM {}".format(", ".join(selects), self.table.__table__)
+            selects = self.selects()
+        source, params = self.table.__table__, []
+        if self._search:
+            source, params = self._search_sql()
+        selects = [self._column(field) for field in selects]
+        sql = "SELECT {} FROM {}".format(", ".join(selects), source)
         where = []
-        params = []
+        for clause, clause_params in extra or []:
+            where.append(clause)
+            params.extend(clause_params)
         for field, value in self._filters.items():
-            where.append("{} = ?".format(field))
+            where.append("{} = ?".format(self._column(field)))
             if field in self.table.columns:
                 value = self.table.columns[field].to_sql(value)
             params.append(value)
@@ -151,6 +346,8 @@ class BaseQuery:
             field = field.lstrip("-")
             if field in self.table.columns:
                 orders.append("{} {}".format(field, "DESC" if desc else "ASC"))
+        if self._search and not orders:
+            orders.append("search_rank")
         if orders:
             sql += " ORDER BY {}".format(", ".join(orders))
         if self._limit:
@@ -170,6 +367,13 @@ class BaseQuery:
         for field, value in self._filters.items():
             wheres.append("{} = ?".format(field))
             params.append(value)
+        if self._search:
+            wheres.append(
+                "{} IN (SELECT rowid FROM {}_fts WHERE {}_fts MATCH ?)".format(
+                    self.table.__pk__, self.table.__table__, self.table.__table__
+                )
+            )
+            params.append(self._search["terms"])
         if not wheres:
             wheres.append("1 = 1")
         sql = "UPDATE {} SET {} WHERE {}".format(
@@ -189,40 +393,151 @@ class BaseQuery:
         first = objects[0] if objects else default
         return first if field is None else getattr(first, field, default)
 
-    def _values(self, rows, lists=False, flat=False):
-        values = []
+    def _prefetch_sql(self, objects):
+        for name in self._prefetch:
+            related = self.table.columns[name].table
+            ids = sorted(
+                {related_pk(getattr(obj, name, None)) for obj in objects} - {None}
+            )
+            batches = []
+            # Stay well under SQLite's default limit of 999 parameters per statement.
+            for start in range(0, len(ids), PREFETCH_BATCH_SIZE):
+                batch = ids[start : start + PREFETCH_BATCH_SIZE]
+                clause = "{} IN ({})".format(
+                    related.__pk__, ", ".join("?" for _ in batch)
+                )
+                batches.append(related.query().to_sql(extra=[(clause, batch)]))
+            yield name, related, batches
+
+    def _prefetched(self, objects, name, related, rows):
+        lookup = {}
         for row in rows:
-            row_values = self.table.from_db(row, as_type=dict)
-            if lists:
-                if flat:
-                    for f in row.keys():
-                        values.append(row_values[f])
-                else:
-                    values.append([row_values[f] for f in row.keys()])
+            obj = related.from_db(row)
+            lookup[obj.pk] = obj
+        for obj in objects:
+            obj.cache(name, lookup.get(related_pk(getattr(obj, name, None))))
+
+    def _convert(self, rows, names):
+        columns = self.table.columns
+        converters = [
+            (idx, columns[name].to_python)
+            for idx, name in enumerate(names)
+            if name in columns and columns[name].to_python is not identity
+        ]
+        if not converters:
+            return [tuple(row) for row in rows]
+        converted = []
+        for row in rows:
+            row = list(row)
+            for idx, to_python in converters:
+                row[idx] = to_python(row[idx])
+            converted.append(tuple(row))
+        return converted
+
+    def _values(self, rows, lists=False, flat=False, names=None):
+        if not rows:
+            return []
+        if names is None:
+            names = rows[0].keys()
+        rows = self._convert(rows, names)
+        if lists:
+            if flat:
+                return [value for row in rows for value in row]
+            return [list(row) for row in rows]
+        if flat:
+            return [{f: value} for row in rows for f, value in zip(names, row)]
+        return [dict(zip(names, row)) for row in rows]
+
+    def _values_list(self, rows, names, flat=False):
+        rows = self._convert(rows, names)
+        if flat:
+            return [value for row in rows for value in row]
+        return rows
+
+    def _columns(self, rows, names, as_numpy=False):
+        if as_numpy and numpy is None:
+            raise ImportError("NumPy is required for as_numpy=True.")
+        rows = self._convert(rows, names)
+        columns = {}
+        for name, values in zip(names, zip(*rows) if rows else [()] * len(names)):
+            if name in self.table.columns:
+                code = typecode(self.table.columns[name].sql_type)
             else:
-                if flat:
-                    for f in row.keys():
-                        values.append({f: row_values[f]})
-                else:
-                    values.append({f: row_values[f] for f in row.keys()})
-        return values
+                code = "q" if name == self.table.__pk__ else None
+            if as_numpy:
+                dtype = {"q": "int64", "d": "float64"}.get(code, object)
+                try:
+                    columns[name] = numpy.array(values, dtype=dtype)
+                except (TypeError, ValueError, OverflowError):
+                    # NULLs (or out of range values) in a numeric column.
+                    columns[name] = numpy.array(values, dtype=object)
+            elif code:
+                try:
+                    columns[name] = array.array(code, values)
+                except (TypeError, OverflowError):
+                    columns[name] = list(values)
+            else:
+                columns[name] = list(values)
+        return columns
+
+
+def map_range(table, path, sql, params, func):
+    # Runs in a worker process, with its own read-only connection.
+    uri = "file:{}?mode=ro".format(urllib.parse.quote(path))
+    connection = sqlite3.connect(uri, uri=True)
+    connection.row_factory = sqlite3.Row
+    try:
+        return [func(table.from_db(row)) for row in connection.execute(sql, params)]
+    finally:
+        connection.close()
 
 
 class Query(BaseQuery):
     def __iter__(self):
         sql, params = self.to_sql()
-        for row in self.table.fetch(sql, params):
-            yield self.table.from_db(row)
+        rows = self.table.fetch(sql, params)
+        if not self._prefetch:
+            for row in rows:
+                yield self.table.from_db(row)
+            return
+        yield from self._prefetch_objects([self.table.from_db(row) for row in rows])
+
+    def _prefetch_objects(self, objects):
+        for name, related, batches in self._prefetch_sql(objects):
+            rows = []
+            for sql, params in batches:
+                if issubclass(related, ShardedTable):
+                    # The related rows could be on any shard.
+                    for shard_rows in related.scatter(
+                        related.connections, sql, params, tuples=False
+                    ):
+                        rows.extend(shard_rows)
+                else:
+                    rows.extend(related.fetch(sql, params))
+            self._prefetched(objects, name, related, rows)
+        return objects
 
     def count(self):
         sql, params = self.to_sql(selects=["count(*)"])
         return self.table.fetch(sql, params)[0][0]
 
     def values(self, *fields, lists=False, flat=False):
-        sql, params = self.to_sql(fields)
+        sql, params = self.to_sql(fields or None)
         rows = self.table.fetch(sql, params)
         return self._values(rows, lists=lists, flat=flat)
 
+    def values_list(self, *fields, flat=False):
+        names = self.selects(fields)
+        sql, params = self.to_sql(names)
+        rows = self.table.fetch(sql, params, tuples=True)
+        return self._values_list(rows, names, flat=flat)
+
+    def columns(self, *fields, as_numpy=False):
+        names = self.selects(fields)
+        sql, params = self.to_sql(names)
+        rows = self.table.fetch(sql, params, tuples=True)
+        return self._columns(rows, names, as_numpy=as_numpy)
+
     def get(self, field=None, default=None, strict=False):
         objects = list(self.limit(2 if strict else 1))
         return self._get(objects, field=field, default=default, strict=strict)
@@ -231,12 +546,79 @@ class Query(BaseQuery):
         sql, params = self.update_sql(**fields)
         return self.table.execute(sql, params).rowcount
 
+    def parallel_map(
+        self, func, workers=None, chunk_rows=PARALLEL_CHUNK_ROWS, ordered=True
+    ):
+        path = self.table.fetch("pragma database_list")[0]["file"]
+        if not path:
+            raise DatabaseError("parallel_map requires a database file.")
+        # Chunks are split and yielded in primary key order, so any other order can't be honored.
+        if self._order or self._search:
+            raise DatabaseError("parallel_map can't be used with order or search.")
+        if self._limit and not ordered:
+            raise DatabaseError("parallel_map can't use a limit with ordered=False.")
+        return self._parallel_map(path, func, workers, chunk_rows, ordered)
+
+    def _parallel_map(self, path, func, workers, chunk_rows, ordered):
+        pk = self.table.__pk__
+        column = "{}.{}".format(self.table.__table__, pk)
+        # Split the matching rows into ranges of (roughly) chunk_rows primary keys, ordered by primary key.
+        query = self.copy(order=[])
+        query._limit = None
+        sql, params = query.to_sql([pk])
+        cursor = self.table.raw(
+            "{} ORDER BY {}".format(sql, column), params, tuples=True
+        )
+        starts = [row[0] for row in itertools.islice(cursor, 0, None, chunk_rows)]
+        chunks = []
+        for start, end in zip(starts, starts[1:] + [None]):
+            extra = [("{} >= ?".format(column), [start])]
+            if end is not None:
+                extra.append(("{} < ?".format(column), [end]))
+            sql, params = query.to_sql(extra=extra)
+            chunks.append((sql + " ORDER BY {}".format(column), params))
+        chunks = iter(chunks)
+        # Only a couple of chunks per worker are in flight, so memory doesn't grow with the whole result set.
+        in_flight = (workers or os.cpu_count() or 1) * 2
+        remaining = self._limit or None
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = []
+        try:
+            while True:
+                for sql, params in itertools.islice(chunks, in_flight - len(futures)):
+                    futures.append(
+                        executor.submit(map_range, self.table, path, sql, params, func)
+                    )
+                if not futures:
+                    break
+                done = futures[0] if ordered else next(as_completed(futures))
+                futures.remove(done)
+                results = done.result()
+                if remaining is not None:
+                    results = results[:remaining]
+                    remaining -= len(results)
+                yield from results
+                if remaining == 0:
+                    break
+        finally:
+            # If iteration stops early, don't bother running the remaining chunks.
+            for f in futures:
+                f.cancel()
+            executor.shutdown()
+
 
 class AsyncQuery(BaseQuery):
     async def __aiter__(self):
         sql, params = self.to_sql()
-        for row in await self.table.fetch(sql, params):
-            yield self.table.from_db(row)
+        rows = await self.table.fetch(sql, params)
+        objects = [self.table.from_db(row) for row in rows]
+        for name, related, batches in self._prefetch_sql(objects):
+            rows = []
+            for sql, params in batches:
+                rows.extend(await related.fetch(sql, params))
+            self._prefetched(objects, name, related, rows)
+        for obj in objects:
+            yield obj
 
     async def count(self):
         sql, params = self.to_sql(selects=["count(*)"])
@@ -244,10 +626,22 @@ class AsyncQuery(BaseQuery):
         return rows[0][0]
 
     async def values(self, *fields, lists=False, flat=False):
-        sql, params = self.to_sql(fields)
+        sql, params = self.to_sql(fields or None)
         rows = await self.table.fetch(sql, params)
         return self._values(rows, lists=lists, flat=flat)
 
+    async def values_list(self, *fields, flat=False):
+        names = self.selects(fields)
+        sql, params = self.to_sql(names)
+        rows = await self.table.fetch(sql, params, tuples=True)
+        return self._values_list(rows, names, flat=flat)
+
+    async def columns(self, *fields, as_numpy=False):
+        names = self.selects(fields)
+        sql, params = self.to_sql(names)
+        rows = await self.table.fetch(sql, params, tuples=True)
+        return self._columns(rows, names, as_numpy=as_numpy)
+
     async def get(self, field=None, default=None, strict=False):
         objects = [obj async for obj in self.limit(2 if strict else 1)]
         return self._get(objects, field=field, default=default, strict=strict)
@@ -258,6 +652,100 @@ class AsyncQuery(BaseQuery):
         return c.rowcount
 
 
+def sql_order(value):
+    # SQLite sorts NULLs first, then numbers, then text, then blobs.
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+
+class OrderKey:
+    def __init__(self, values, desc):
+        self.values = [sql_order(value) for value in values]
+        self.desc = desc
+
+    def __lt__(self, other):
+        for a, b, desc in zip(self.values, other.values, self.desc):
+            if a != b:
+                return a > b if desc else a < b
+        return False
+
+
+class ShardedQuery(Query):
+    def connections(self):
+        # A row's primary key always points at the shard it is stored on, even if its shard key was changed in memory.
+        if self.table.__pk__ in self._filters:
+            return [self.table.pk_shard(self._filters[self.table.__pk__])]
+        key = self.table.__shard_key__
+        if key in self._filters:
+            return [self.table.shard(self._filters[key])]
+        return self.table.connections
+
+    def _merged(self, names):
+        # Each shard orders and limits its own rows, which are then merged and limited again.
+        orders = [f for f in self._order if f.lstrip("-") in self.table.columns]
+        selects = list(names) + [
+            f.lstrip("-") for f in orders if f.lstrip("-") not in names
+        ]
+        sql, params = self.to_sql(selects)
+        results = self.table.scatter(self.connections(), sql, params)
+        if orders:
+            indexes = [selects.index(f.lstrip("-")) for f in orders]
+            desc = [f.startswith("-") for f in orders]
+            rows = heapq.merge(
+                *results,
+                key=lambda row: OrderKey([row[idx] for idx in indexes], desc),
+            )
+        else:
+            rows = itertools.chain.from_iterable(results)
+        if self._limit:
+            rows = itertools.islice(rows, self._limit)
+        return [row[: len(names)] for row in rows]
+
+    def __iter__(self):
+        names = self.selects()
+        objects = [
+            self.table.from_db(dict(zip(names, row))) for row in self._merged(names)
+        ]
+        yield from self._prefetch_objects(objects)
+
+    def count(self):
+        sql, params = self.to_sql(selects=["count(*)"])
+        results = self.table.scatter(self.connections(), sql, params)
+        return sum(rows[0][0] for rows in results)
+
+    def values(self, *fields, lists=False, flat=False):
+        names = self.selects(fields)
+        rows = self._merged(names)
+        return self._values(rows, lists=lists, flat=flat, names=names)
+
+    def values_list(self, *fields, flat=False):
+        names = self.selects(fields)
+        return self._values_list(self._merged(names), names, flat=flat)
+
+    def columns(self, *fields, as_numpy=False):
+        names = self.selects(fields)
+        return self._columns(self._merged(names), names, as_numpy=as_numpy)
+
+    def parallel_map(self, *args, **kwargs):
+        raise DatabaseError("parallel_map is not supported for sharded tables.")
+
+    def search(self, *args, **kwargs):
+        # bm25 ranks depend on each shard's own statistics, so they can't be merged across shards.
+        raise DatabaseError("search is not supported for sharded tables.")
+
+    def update(self, **fields):
+        if self.table.__shard_key__ in fields:
+            raise DatabaseError("The shard key of a ShardedTable can't be updated.")
+        sql, params = self.update_sql(**fields)
+        results = self.table.scatter(self.connections(), sql, params, fetch=False)
+        return sum(c.rowcount for c in results)
+
+
 class BaseTable:
     __table__ = None
     __connection__ = None
@@ -283,6 +771,20 @@ class BaseTable:
 
     pk = property(get_pk, set_pk)
 
+    def cache(self, name, obj):
+        # Related objects are cached along with the key they were fetched for, so changing the key invalidates them.
+        self.__dict__.setdefault("_related", {})[name] = (
+            related_pk(getattr(self, name, None)),
+            obj,
+        )
+
+    def cached(self, name):
+        value = getattr(self, name, None)
+        if value is None or isinstance(value, BaseTable):
+            return True, value
+        key, obj = self.__dict__.get("_related", {}).get(name, (None, None))
+        return key == value, obj
+
     @classmethod
     def from_db(cls, row, as_type=None):
         fields = {}
@@ -325,9 +827,12 @@ class BaseTable:
         return False
 
     @classmethod
-    def raw(cls, sql, params=None, fetch=False):
+    def raw(cls, sql, params=None, fetch=False, tuples=False, connection=None):
         logger.debug("%s :: %s %s", cls.__name__, sql, params or [])
-        c = cls.__connection__.execute(sql, params or [])
+        c = (connection or cls.__connection__).cursor()
+        if tuples:
+            c.row_factory = None
+        c.execute(sql, params or [])
         return c.fetchall() if fetch else c
 
     @classmethod
@@ -335,46 +840,155 @@ class BaseTable:
         table_name = cls.__table__
         current = {}
         for row in cls.raw("pragma table_info({})".format(table_name)):
-            current[row["name"]] = row["type"]
+            current[row["name"]] = row
         if current:
-            for name, col in cls.columns.items():
+            rebuild = False
+            declared = cls.declared_schema()
+            for name in cls.columns:
                 if name in current:
-                    # Check for type mismatches and warn the user
-                    col_type = col.sql_type.split()[0]
-                    if current[name] != col_type:
-                        logger.warning(
-                            "Type mismatch for {}.{} ({} vs. {})".format(
-                                table_name, name, current[name], col_type
+                    # Type and NOT NULL changes can't be made with ALTER TABLE, the table needs to be rebuilt.
+                    if current[name]["type"] != declared[name]["type"]:
+                        logger.info(
+                            "Type change for {}.{} ({} to {})".format(
+                                table_name,
+                                name,
+                                current[name]["type"],
+                                declared[name]["type"],
                             )
                         )
-                else:
-                    # Create nonexistent columns
-                    yield "ALTER TABLE {} ADD COLUMN {}".format(
-                        table_name, col.typedef(name)
-                    )
+                        rebuild = True
+                    elif current[name]["notnull"] != declared[name]["notnull"]:
+                        logger.info(
+                            "NOT NULL change for {}.{}".format(table_name, name)
+                        )
+                        rebuild = True
             for name in current:
                 if name not in cls.columns:
                     logger.warning("Orphaned column {}.{}".format(table_name, name))
+            if rebuild:
+                yield cls.rebuild(current)
+            for name, col in cls.columns.items():
+                if name not in current:
+                    # Create nonexistent columns (unless they were just created by rebuilding the table)
+                    if not rebuild:
+                        yield "ALTER TABLE {} ADD COLUMN {}".format(
+                            table_name, col.typedef(name)
+                        )
+                    index = col.index_sql(table_name, name)
+                    if index:
+                        yield index
         else:
             parts = [col.typedef(name) for name, col in cls.columns.items()]
             yield "CREATE TABLE {} ({})".format(table_name, ", ".join(parts))
+            for name, col in cls.columns.items():
+                index = col.index_sql(table_name, name)
+                if index:
+                    yield index
+        yield from cls.search_changes()
+
+    @classmethod
+    def declared_schema(cls):
+        # What SQLite stores for the declared columns (which may not match sql_type and null as written), found by
+        # creating them in the temp schema.
+        temp_name = "dorm_declared_{}".format(cls.__table__)
+        parts = [col.typedef(name) for name, col in cls.columns.items()]
+        cls.raw("CREATE TABLE temp.{} ({})".format(temp_name, ", ".join(parts)))
+        try:
+            return {
+                row["name"]: row
+                for row in cls.raw("pragma temp.table_info({})".format(temp_name))
+            }
+        finally:
+            cls.raw("DROP TABLE temp.{}".format(temp_name))
+
+    @classmethod
+    def searchable(cls):
+        return [name for name, col in cls.columns.items() if col.searchable]
+
+    @classmethod
+    def search_changes(cls):
+        # Searchable columns are indexed by an external content FTS5 table, kept in sync by triggers.
+        table_name = cls.__table__
+        fts = "{}_fts".format(table_name)
+        names = cls.searchable()
+        current = [row["name"] for row in cls.raw("pragma table_info({})".format(fts))]
+        if current == names:
+            return
+        if current:
+            for suffix in ("ai", "ad", "au"):
+                yield "DROP TRIGGER IF EXISTS {}_{}".format(fts, suffix)
+            yield "DROP TABLE {}".format(fts)
+        if not names:
+            return
+        pk = cls.__pk__
+        columns = ", ".join(names)
+        new = ", ".join("new." + name for name in names)
+        old = ", ".join("old." + name for name in names)
+        insert = "INSERT INTO {} (rowid, {}) VALUES (new.{}, {});".format(
+            fts, columns, pk, new
+        )
+        delete = (
+            "INSERT INTO {0} ({0}, rowid, {1}) VALUES ('delete', old.{2}, {3});".format(
+                fts, columns, pk, old
+            )
+        )
+        yield "CREATE VIRTUAL TABLE {} USING fts5({}, content='{}', content_rowid='{}')".format(
+            fts, columns, table_name, pk
+        )
+        yield "CREATE TRIGGER {}_ai AFTER INSERT ON {} BEGIN {} END".format(
+            fts, table_name, insert
+        )
+        yield "CREATE TRIGGER {}_ad AFTER DELETE ON {} BEGIN {} END".format(
+            fts, table_name, delete
+        )
+        yield "CREATE TRIGGER {}_au AFTER UPDATE ON {} BEGIN {} {} END".format(
+            fts, table_name, delete, insert
+        )
+        # Index any existing rows.
+        yield "INSERT INTO {0} ({0}) VALUES ('rebuild')".format(fts)
+
+    @classmethod
+    def rebuild(cls, current):
+        parts = [col.typedef(name) for name, col in cls.columns.items()]
+        copied = [name for name in cls.columns if name in current]
+        for name, row in current.items():
+            if name not in cls.columns:
+                # Orphaned columns (and their data) are carried over as they are.
+                col = Column(
+                    row["type"], null=not row["notnull"], default=row["dflt_value"]
+                )
+                parts.append(col.typedef(name))
+                copied.append(name)
+        if cls.__pk__ not in cls.columns:
+            # Without an INTEGER PRIMARY KEY, the rowid is the primary key and needs to be preserved explicitly.
+            copied.insert(0, "rowid")
+        return Rebuild(cls.__table__, parts, copied)
 
     @classmethod
     def query(cls, **kwargs):
         return cls.query_class(cls).filter(**kwargs)
 
-    def insert_sql(self):
+    def insert_sql(self, next_pk=None):
         names = []
+        values = []
         params = []
         for name, col in self.__class__.columns.items():
             if not col.primary_key and hasattr(self, name):
                 names.append(name)
+                values.append("?")
                 params.append(col.to_sql(getattr(self, name)))
         if self.pk:
             names.insert(0, self.__class__.__pk__)
+            values.insert(0, "?")
             params.insert(0, self.pk)
+        elif next_pk:
+            # An SQL expression (and its params) that allocates the primary key.
+            expr, expr_params = next_pk
+            names.insert(0, self.__class__.__pk__)
+            values.insert(0, expr)
+            params[0:0] = expr_params
         sql = "INSERT INTO {} ({}) VALUES ({})".format(
-            self.__class__.__table__, ", ".join(names), ", ".join("?" for n in names)
+            self.__class__.__table__, ", ".join(names), ", ".join(values)
         )
         return sql, params
 
@@ -383,8 +997,8 @@ class Table(BaseTable):
     query_class = Query
 
     @classmethod
-    def fetch(cls, sql, params=None):
-        return cls.raw(sql, params=params, fetch=True)
+    def fetch(cls, sql, params=None, tuples=False):
+        return cls.raw(sql, params=params, fetch=True, tuples=tuples)
 
     @classmethod
     def execute(cls, sql, params=None):
@@ -413,19 +1027,110 @@ class Table(BaseTable):
         self.__dict__.update(obj.__dict__)
         return self
 
+    def related(self, name):
+        found, obj = self.cached(name)
+        if not found:
+            table = self.__class__.columns[name].table
+            obj = table.query(pk=getattr(self, name)).get()
+            self.cache(name, obj)
+        return obj
+
+
+class GroupCommit:
+    # Coalesces writes from concurrent AsyncTable coroutines. Statements arriving within `window` seconds of each other
+    # (up to `batch_size` of them) are executed in a single transaction on the table's executor, and each caller gets
+    # back its own cursor, or the exception its statement raised.
+
+    def __init__(self, window=0.005, batch_size=100):
+        self.window = window
+        self.batch_size = batch_size
+        self.pending = []
+        self.timer = None
+
+    async def execute(self, table, sql, params=None):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((table, sql, params, future))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        groups = {}
+        for item in batch:
+            groups.setdefault(item[0].__connection__, []).append(item)
+        loop = asyncio.get_event_loop()
+        for connection, items in groups.items():
+            statements = [(table, sql, params) for table, sql, params, _ in items]
+            done = loop.run_in_executor(
+                items[0][0].executor, self.commit, connection, statements
+            )
+            done.add_done_callback(lambda done, items=items: self.resolve(items, done))
+
+    @staticmethod
+    def commit(connection, statements):
+        logger.debug("Committing %d grouped statements", len(statements))
+        results = []
+        start = 0
+        connection.execute("SAVEPOINT dorm_group_commit")
+        try:
+            for table, sql, params in statements:
+                try:
+                    results.append(table.raw(sql, params))
+                except sqlite3.Error as e:
+                    # Usually SQLite only rolls back the failed statement, and the rest of the group can still commit.
+                    results.append(e)
+                    if not connection.in_transaction:
+                        # But some errors (RAISE(ROLLBACK) triggers, SQLITE_FULL, I/O errors) roll back the whole
+                        # transaction, so the statements run before it failed too, and the rest get a new savepoint.
+                        results[start:] = [
+                            r if isinstance(r, BaseException) else e
+                            for r in results[start:]
+                        ]
+                        start = len(results)
+                        connection.execute("SAVEPOINT dorm_group_commit")
+            connection.execute("RELEASE dorm_group_commit")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK TO dorm_group_commit")
+                connection.execute("RELEASE dorm_group_commit")
+            raise
+        return results
+
+    @staticmethod
+    def resolve(items, done):
+        error = done.exception()
+        results = [error] * len(items) if error else done.result()
+        for (_, _, _, future), result in zip(items, results):
+            if future.done():
+                continue
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
 
 class AsyncTable(BaseTable):
     query_class = AsyncQuery
     executor = ThreadPoolExecutor(max_workers=1)
+    writer = None
 
     @classmethod
-    async def fetch(cls, sql, params=None):
+    async def fetch(cls, sql, params=None, tuples=False):
         return await asyncio.get_event_loop().run_in_executor(
-            cls.executor, cls.raw, sql, params, True
+            cls.executor, cls.raw, sql, params, True, tuples
         )
 
     @classmethod
     async def execute(cls, sql, params=None):
+        if cls.writer is not None:
+            return await cls.writer.execute(cls, sql, params)
         return await asyncio.get_event_loop().run_in_executor(
             cls.executor, cls.raw, sql, params, False
         )
@@ -454,6 +1159,200 @@ class AsyncTable(BaseTable):
         self.__dict__.update(obj.__dict__)
         return self
 
+    async def related(self, name):
+        found, obj = self.cached(name)
+        if not found:
+            table = self.__class__.columns[name].table
+            obj = await table.query(pk=getattr(self, name)).get()
+            self.cache(name, obj)
+        return obj
+
+
+class ShardedTable(Table):
+    # Rows are spread across several database files by the value of __shard_key__. Queries filtered on the shard key go
+    # to a single shard, others run on every shard in parallel, and their results are merged.
+    __shard_key__ = None
+    __shards__ = ()
+
+    query_class = ShardedQuery
+    connections = []
+    pool = None
+
+    @classmethod
+    def bind(cls, connection, inspect=False):
+        super().bind(connection, inspect=inspect)
+        if not cls.__shards__:
+            return cls
+        if cls.__shard_key__ == cls.__pk__:
+            # Primary keys are allocated by the shard a row goes to, so they can't also choose the shard.
+            raise DatabaseError(
+                "{} can't use its primary key as the __shard_key__.".format(
+                    cls.__name__
+                )
+            )
+        if cls.pool is not None:
+            cls.pool.shutdown(wait=False)
+        cls.connections = [connect(path) for path in cls.__shards__]
+        cls.pool = ThreadPoolExecutor(max_workers=len(cls.connections))
+        cls.__connection__ = cls.connections[0]
+        return cls
+
+    @classmethod
+    def update_shards(cls, cache_schema=False):
+        # Shards live outside the main database (and its migrations), so setup keeps their schema up to date here.
+        fingerprint = schema_fingerprint([cls]) if cache_schema else None
+        try:
+            for shard in cls.connections:
+                version = shard.execute("pragma user_version").fetchone()[0]
+                if fingerprint and version == fingerprint:
+                    continue
+                cls.__connection__ = shard
+                for sql in list(cls.schema_changes()):
+                    if isinstance(sql, Rebuild):
+                        sql(shard)
+                    else:
+                        shard.execute(sql)
+                if fingerprint:
+                    shard.execute("pragma user_version = {}".format(fingerprint))
+        finally:
+            cls.__connection__ = cls.connections[0]
+
+    @classmethod
+    def shard_index(cls, value):
+        if not cls.__shard_key__ or not cls.connections:
+            raise DatabaseError(
+                "{} needs a __shard_key__ and __shards__.".format(cls.__name__)
+            )
+        if value is None:
+            raise DatabaseError(
+                "{} rows need a value for {}.".format(cls.__name__, cls.__shard_key__)
+            )
+        if cls.__shard_key__ in cls.columns:
+            value = cls.columns[cls.__shard_key__].to_sql(value)
+        if isinstance(value, int):
+            return value % len(cls.connections)
+        return zlib.crc32(str(value).encode("utf-8")) % len(cls.connections)
+
+    @classmethod
+    def shard(cls, value):
+        return cls.connections[cls.shard_index(value)]
+
+    @classmethod
+    def pk_shard(cls, pk):
+        # Shard i only holds primary keys i + 1, i + 1 + n, i + 1 + 2n, ... (see save).
+        return cls.connections[(int(pk) - 1) % len(cls.connections)]
+
+    @classmethod
+    def scatter(cls, connections, sql, params=None, fetch=True, tuples=True):
+        def run(connection):
+            return cls.raw(
+                sql, params, fetch=fetch, tuples=tuples, connection=connection
+            )
+
+        if len(connections) == 1:
+            return [run(connections[0])]
+        return list(cls.pool.map(run, connections))
+
+    def save(self, force_insert=False):
+        cls = self.__class__
+        key = getattr(self, cls.__shard_key__, None)
+        if force_insert or not self.pk:
+            index = cls.shard_index(key)
+            count = len(cls.connections)
+            if self.pk:
+                if (self.pk - 1) % count != index:
+                    raise DatabaseError(
+                        "Primary key {} does not belong to shard {} of {}.".format(
+                            self.pk, index, cls.__name__
+                        )
+                    )
+                sql, params = self.insert_sql()
+            else:
+                # Each shard allocates primary keys from its own residue class, so they are unique across shards.
+                sql, params = self.insert_sql(
+                    next_pk=(
+                        "(SELECT coalesce(max({}), ?) + ? FROM {})".format(
+                            cls.__pk__, cls.__table__
+                        ),
+                        [index + 1 - count, count],
+                    )
+                )
+            self.pk = cls.raw(sql, params, connection=cls.connections[index]).lastrowid
+        else:
+            updated = cls.query(pk=self.pk, **{cls.__shard_key__: key}).update(
+                **{
+                    name: col.to_sql(getattr(self, name))
+                    for name, col in cls.columns.items()
+                    if not col.primary_key
+                    and name != cls.__shard_key__
+                    and hasattr(self, name)
+                }
+            )
+            if not updated and cls.query(pk=self.pk).count():
+                raise DatabaseError("The shard key of a ShardedTable can't be changed.")
+        return self
+
+
+class Rebuild:
+    # A schema change that ALTER TABLE can't make. The table is recreated with the new column definitions, existing
+    # rows are copied over in batches, and the table's indexes and triggers are recreated.
+
+    def __init__(self, table_name, typedefs, columns, batch_size=REBUILD_BATCH_SIZE):
+        self.table_name = table_name
+        self.typedefs = typedefs
+        self.columns = columns
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        return "Rebuild({!r}, {!r}, {!r})".format(
+            self.table_name, self.typedefs, self.columns
+        )
+
+    def __call__(self, connection):
+        new_name = "{}_rebuild".format(self.table_name)
+        columns = ", ".join(self.columns)
+        with atomic(connection, "dorm_rebuild"):
+            extras = [sql for _, sql in schema_sql(connection, self.table_name)]
+            connection.execute(
+                "CREATE TABLE {} ({})".format(new_name, ", ".join(self.typedefs))
+            )
+            low, total = connection.execute(
+                "SELECT min(rowid), count(*) FROM {}".format(self.table_name)
+            ).fetchone()
+            # Copy in rowid order, a batch at a time (rowids are preserved in the new table).
+            sql = "INSERT INTO {} ({}) SELECT {} FROM {} WHERE rowid {} ? ORDER BY rowid LIMIT {}"
+            copied, op = 0, ">="
+            while copied < total:
+                count = connection.execute(
+                    sql.format(
+                        new_name,
+                        columns,
+                        columns,
+                        self.table_name,
+                        op,
+                        self.batch_size,
+                    ),
+                    (low,),
+                ).rowcount
+                if not count:
+                    break
+                copied += count
+                low = connection.execute(
+                    "SELECT max(rowid) FROM {}".format(new_name)
+                ).fetchone()[0]
+                op = ">"
+                logger.info(
+                    "Rebuilding {}: copied {}/{} rows".format(
+                        self.table_name, copied, total
+                    )
+                )
+            connection.execute("DROP TABLE {}".format(self.table_name))
+            connection.execute(
+                "ALTER TABLE {} RENAME TO {}".format(new_name, self.table_name)
+            )
+            for sql in extras:
+                connection.execute(sql)
+
 
 class Migration(Table):
     columns = {"module": String, "name": String, "applied": Timestamp}
@@ -465,35 +1364,79 @@ class Migration(Table):
         migration_path = os.path.join(migration_dir, filename)
         logger.info("Writing migration to {}".format(migration_path))
         with open(migration_path, "w") as f:
+            if any(isinstance(sql, Rebuild) for sql in sql_statements):
+                f.write("import dorm\n\n\n")
             f.write("def forward(connection):\n")
             if sql_statements:
                 for sql in sql_statements:
-                    f.write(
-                        '    connection.execute("{}")\n'.format(sql.replace('"', '\\"'))
-                    )
+                    if isinstance(sql, Rebuild):
+                        f.write("    dorm.{!r}(connection)\n".format(sql))
+                    else:
+                        f.write(
+                            '    connection.execute("{}")\n'.format(
+                                sql.replace('"', '\\"')
+                            )
+                        )
             else:
                 f.write("    raise NotImplementedError()\n")
 
     @classmethod
-    def migrate(cls, module, connection):
-        latest = (
-            cls.query(module=module.__name__).order("-applied").get("name")
-            if cls.exists()
-            else None
-        )
-        migration_names = {
+    def names(cls, module):
+        return {
             name
             for _, name, is_pkg in pkgutil.iter_modules(module.__path__)
             if not is_pkg and name[0] not in "_~"
         }
-        for name in sorted(migration_names):
-            # TODO: select all applied, and check for old skipped migrations which may indicate merges
-            if latest is None or name > latest:
+
+    @classmethod
+    def migrate(cls, module, connection, batch=False):
+        applied = (
+            set(cls.query(module=module.__name__).values("name", lists=True, flat=True))
+            if cls.exists()
+            else set()
+        )
+        latest = max(applied) if applied else None
+        pending = sorted(cls.names(module) - applied)
+        for name in pending:
+            if latest is not None and name < latest:
+                # Usually the result of merging branches that each added migrations.
+                logger.warning(
+                    'Migration "{}.{}" is older than the latest applied migration "{}"'.format(
+                        module.__name__, name, latest
+                    )
+                )
+        # Each migration runs in its own transaction, or the whole batch runs in one.
+        with atomic(connection, "dorm_migrate") if batch else contextlib.ExitStack():
+            for name in pending:
                 modname = "{}.{}".format(module.__name__, name)
                 logger.info('Running migration "{}"'.format(modname))
                 mod = importlib.import_module(modname)
-                mod.forward(connection)
-                cls.insert(module=module.__name__, name=name)
+                connection.execute("SAVEPOINT dorm_migration")
+                try:
+                    mod.forward(connection)
+                    committed = not connection.in_transaction
+                    cls.insert(
+                        module=module.__name__,
+                        name=name,
+                        applied=datetime.datetime.utcnow().strftime(
+                            "%Y-%m-%d %H:%M:%S"
+                        ),
+                    )
+                except BaseException:
+                    if connection.in_transaction:
+                        connection.execute("ROLLBACK TO dorm_migration")
+                        connection.execute("RELEASE dorm_migration")
+                    raise
+                if committed:
+                    # executescript, commit, and VACUUM end the transaction, so the migration was applied as it went.
+                    logger.warning(
+                        'Migration "{}" committed its own transaction'.format(modname)
+                    )
+                    if batch:
+                        # Only the remaining migrations of the batch can still run in one transaction.
+                        connection.execute("SAVEPOINT dorm_migrate")
+                else:
+                    connection.execute("RELEASE dorm_migration")
 
 
 class Config:
@@ -522,10 +1465,108 @@ class Config:
                 f.write("{} = {}\n".format(key, getattr(self, key)))
 
 
-def setup(db_path=":memory:", models=None, migrations=None, migrate=True):
+def schema_fingerprint(tables, migrations=None):
+    # A hash of the declared schema (and available migrations), small enough to store in SQLite's user_version.
+    h = hashlib.sha1()
+    for table in sorted(tables, key=lambda t: t.__table__):
+        h.update(table.__table__.encode("utf-8"))
+        for name, col in table.columns.items():
+            h.update(col.typedef(name).encode("utf-8"))
+            h.update(str(col.index_sql(table.__table__, name)).encode("utf-8"))
+            h.update(str(col.searchable).encode("utf-8"))
+    if migrations:
+        h.update(migrations.__name__.encode("utf-8"))
+        for name in sorted(Migration.names(migrations)):
+            h.update(name.encode("utf-8"))
+    return int(h.hexdigest()[:7], 16) or 1
+
+
+def connect(db_path=":memory:"):
     connection = sqlite3.connect(db_path, check_same_thread=False)
     connection.isolation_level = None
     connection.row_factory = sqlite3.Row
+    return connection
+
+
+def copy_database(source, connection):
+    # Unlike iterdump, this keeps implicit rowids, and lets virtual tables create their own shadow tables (whose rows
+    # are then copied like any other table's).
+    schema = source.execute(
+        "SELECT type, name, sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY rowid"
+    ).fetchall()
+    with atomic(connection, "dorm_clone"):
+        virtual = set()
+        for kind, name, sql in schema:
+            exists = connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = ?", [name]
+            ).fetchone()
+            if kind == "table" and not exists:
+                connection.execute(sql)
+                if sql.upper().startswith("CREATE VIRTUAL TABLE"):
+                    virtual.add(name)
+        names = [name for kind, name, sql in schema if kind == "table"]
+        if source.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_sequence'"
+        ).fetchone():
+            names.append("sqlite_sequence")
+        for name in names:
+            if name in virtual:
+                continue
+            try:
+                cursor = source.execute("SELECT rowid, * FROM {}".format(name))
+            except sqlite3.OperationalError:
+                # WITHOUT ROWID tables.
+                cursor = source.execute("SELECT * FROM {}".format(name))
+            columns = [c[0] for c in cursor.description]
+            connection.executemany(
+                "INSERT OR REPLACE INTO {} ({}) VALUES ({})".format(
+                    name, ", ".join(columns), ", ".join("?" for c in columns)
+                ),
+                cursor,
+            )
+        # Indexes and triggers are created last, so triggers don't fire for the copied rows.
+        for kind, name, sql in schema:
+            if kind != "table":
+                connection.execute(sql)
+        version = source.execute("pragma user_version").fetchone()[0]
+        connection.execute("pragma user_version = {}".format(int(version)))
+
+
+def clone(template, connection):
+    if hasattr(template, "execute"):
+        source = template
+    else:
+        # Open template files read-only, so a mistyped path fails instead of creating an empty database.
+        uri = "file:{}?mode=ro".format(urllib.parse.quote(template))
+        try:
+            source = sqlite3.connect(uri, uri=True)
+        except sqlite3.Error as e:
+            raise DatabaseError("Could not open template {}: {}".format(template, e))
+    try:
+        if hasattr(source, "backup"):
+            # Copying the pages of an already set up database is much faster than creating the schema from scratch.
+            source.backup(connection)
+        else:
+            # Connection.backup is only available on Python 3.7+, so copy the schema and rows instead.
+            copy_database(source, connection)
+    finally:
+        if source is not template:
+            source.close()
+
+
+def setup(
+    db_path=":memory:",
+    models=None,
+    migrations=None,
+    migrate=True,
+    cache_schema=False,
+    template=None,
+):
+    start = time.perf_counter()
+    connection = connect(db_path)
+    if template is not None:
+        clone(template, connection)
+        logger.debug("Cloned template in %.1fms", (time.perf_counter() - start) * 1000)
 
     # Generate a list of Table classes to find schema changes for.
     tables = []
@@ -545,6 +1586,11 @@ def setup(db_path=":memory:", models=None, migrations=None, migrate=True):
                     'Binding model "{}.{}"'.format(cls.__module__, cls.__name__)
                 )
                 tables.append(cls.bind(connection))
+    bound = time.perf_counter()
+    logger.debug("Bound %d models in %.1fms", len(tables), (bound - start) * 1000)
+    sharded = [t for t in tables if issubclass(t, ShardedTable) and t.connections]
+    for table in sharded:
+        table.update_shards(cache_schema=cache_schema)
 
     # Migrate the database to either the latest migration (if using migrations), or the latest schema.
     migrations_mod = None
@@ -552,13 +1598,36 @@ def setup(db_path=":memory:", models=None, migrations=None, migrate=True):
         try:
             migrations_mod = importlib.import_module(migrations)
             tables.append(Migration.bind(connection))
-            if migrate:
-                Migration.migrate(migrations_mod, connection)
         except ImportError:
             logger.warning('Could not import migrations from "{}"'.format(migrations))
+    # When caching the schema, skip introspection and migrations entirely if nothing changed since the last setup.
+    fingerprint = schema_fingerprint(tables, migrations_mod) if cache_schema else None
+    if template is not None:
+        logger.debug("Using the schema of the template database")
+    elif (
+        fingerprint
+        and connection.execute("pragma user_version").fetchone()[0] == fingerprint
+    ):
+        logger.debug("Schema fingerprint {} is current".format(fingerprint))
+    elif migrations:
+        if migrations_mod and migrate:
+            Migration.migrate(migrations_mod, connection)
+            if fingerprint:
+                connection.execute("pragma user_version = {}".format(fingerprint))
     else:
-        for sql in itertools.chain.from_iterable(t.schema_changes() for t in tables):
-            connection.execute(sql)
+        changes = (t.schema_changes() for t in tables if t not in sharded)
+        for sql in itertools.chain.from_iterable(changes):
+            if isinstance(sql, Rebuild):
+                sql(connection)
+            else:
+                connection.execute(sql)
+        if fingerprint:
+            connection.execute("pragma user_version = {}".format(fingerprint))
+    logger.debug(
+        "Schema checked in %.1fms (%.1fms total)",
+        (time.perf_counter() - bound) * 1000,
+        (time.perf_counter() - start) * 1000,
+    )
 
     return connection, tables, migrations_mod
 
@@ -595,16 +1664,199 @@ def newmigration(connection, tables, migrations):
         Migration.write(migrations, [])
 
 
+def find_table(tables, name):
+    for table in tables:
+        if name in (table.__name__, table.__table__):
+            return table
+    raise DatabaseError('No model named "{}"'.format(name))
+
+
+def log_progress(action, table, count, start):
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "{} {} {} rows ({:.0f} rows/sec)".format(
+            action, count, table.__table__, count / elapsed if elapsed else 0
+        )
+    )
+
+
+def dump(table, f, format="jsonl", batch_size=LOAD_BATCH_SIZE):
+    # JSONL rows are converted with each column's to_python, CSV rows are written as they are stored.
+    query = table.query()
+    names = query.selects()
+    sql, params = query.to_sql(names)
+    columns = [table.columns.get(name) for name in names]
+    writer = csv.writer(f) if format == "csv" else None
+    if writer:
+        writer.writerow(names)
+    # Sharded tables are dumped one shard at a time.
+    connections = [table.__connection__]
+    if issubclass(table, ShardedTable) and table.connections:
+        connections = table.connections
+    start = time.perf_counter()
+    count = 0
+    for connection in connections:
+        cursor = table.raw(sql, params, tuples=True, connection=connection)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                values = []
+                for col, value in zip(columns, row):
+                    if col and not writer:
+                        value = col.to_python(value)
+                    if isinstance(value, bytes):
+                        value = base64.b64encode(value).decode("ascii")
+                    values.append(value)
+                if writer:
+                    writer.writerow(values)
+                else:
+                    f.write(json.dumps(dict(zip(names, values)), default=str) + "\n")
+            count += len(rows)
+            log_progress("Dumped", table, count, start)
+    return count
+
+
+def load_value(col, value, format):
+    if col is None:
+        return value
+    if format == "csv":
+        # CSV has no NULL, empty values are loaded as NULL where the column allows it.
+        if value == "" and col.null:
+            return None
+    else:
+        value = col.to_sql(value)
+    if isinstance(value, str) and col.sql_type.lower().startswith("blob"):
+        value = base64.b64decode(value)
+    return value
+
+
+def load(table, f, format="jsonl", batch_size=LOAD_BATCH_SIZE, drop_indexes=False):
+    if issubclass(table, ShardedTable):
+        # Loaded rows would bypass shard routing and the shard-encoded primary keys.
+        raise DatabaseError("load is not supported for sharded tables.")
+    connection = table.__connection__
+    # Field names end up in the INSERT statements, so only the model's own columns are allowed.
+    fields = set(table.columns) | {table.__pk__}
+
+    def check(names):
+        unknown = set(names) - fields
+        if unknown:
+            raise DatabaseError(
+                "Unknown fields for {}: {}".format(
+                    table.__name__, ", ".join(sorted(unknown))
+                )
+            )
+
+    if format == "csv":
+        records = csv.DictReader(f)
+        check(records.fieldnames or [])
+    else:
+        records = (json.loads(line) for line in f if line.strip())
+    indexes = schema_sql(connection, table.__table__, types=("index",))
+    if drop_indexes:
+        # Building indexes once at the end is much faster than maintaining them for every inserted row.
+        for name, _ in indexes:
+            connection.execute("DROP INDEX {}".format(name))
+    start = time.perf_counter()
+    count = 0
+    try:
+        while True:
+            batch = list(itertools.islice(records, batch_size))
+            if not batch:
+                break
+            # JSONL records can each have their own fields, so every batch is checked before it is inserted.
+            for record in batch:
+                check(record)
+            # Rows are grouped by the fields they have, so each group is a single executemany.
+            groups = {}
+            for record in batch:
+                groups.setdefault(tuple(record), []).append(
+                    [
+                        load_value(table.columns.get(name), value, format)
+                        for name, value in record.items()
+                    ]
+                )
+            with atomic(connection, "dorm_load"):
+                for names, rows in groups.items():
+                    sql = "INSERT INTO {} ({}) VALUES ({})".format(
+                        table.__table__,
+                        ", ".join(names),
+                        ", ".join("?" for _ in names),
+                    )
+                    connection.executemany(sql, rows)
+            count += len(batch)
+            log_progress("Loaded", table, count, start)
+    finally:
+        if drop_indexes:
+            for _, sql in indexes:
+                connection.execute(sql)
+    return count
+
+
 def main():
     logging.basicConfig(level=logging.DEBUG)
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-c", "--config", default="dorm.cfg", help="The dorm config file to use."
     )
-    parser.add_argument("command", choices=["init", "migrate", "generate", "new"])
+    parser.add_argument(
+        "command", choices=["init", "migrate", "generate", "new", "dump", "load"]
+    )
+    parser.add_argument("model", nargs="?", help="The model to dump or load.")
+    parser.add_argument(
+        "path",
+        nargs="?",
+        help="The file to dump to or load from (defaults to stdout or stdin).",
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        choices=["jsonl", "csv"],
+        help="The dump/load file format (defaults to the file extension, or jsonl).",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch-size",
+        type=int,
+        default=LOAD_BATCH_SIZE,
+        help="The number of rows to dump or load at a time.",
+    )
+    parser.add_argument(
+        "--drop-indexes",
+        action="store_true",
+        help="Drop the table's indexes while loading, and recreate them afterwards.",
+    )
     args = parser.parse_args()
     if args.command == "init":
         Config(args.config).save()
+    elif args.command in ("dump", "load"):
+        if not args.model:
+            parser.error("The {} command requires a model.".format(args.command))
+        connection, tables, migrations = configure(args.config)
+        table = find_table(tables, args.model)
+        fmt = args.format or (
+            "csv" if args.path and args.path.endswith(".csv") else "jsonl"
+        )
+        if args.command == "dump":
+            f = open(args.path, "w", newline="") if args.path else sys.stdout
+        else:
+            f = open(args.path, "r", newline="") if args.path else sys.stdin
+        try:
+            if args.command == "dump":
+                dump(table, f, format=fmt, batch_size=args.batch_size)
+            else:
+                load(
+                    table,
+                    f,
+                    format=fmt,
+                    batch_size=args.batch_size,
+                    drop_indexes=args.drop_indexes,
+                )
+        finally:
+            if args.path:
+                f.close()
     else:
         params = configure(args.config)
         handler = {"migrate": migrate, "generate": generate, "new": newmigration}[
@@ -614,4 +1866,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    # Run main from the importable module, so models subclass the same Table classes it checks against.
+    import dorm
+
+    dorm.main()
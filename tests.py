@@ -1,12 +1,18 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import array
 import asyncio
+import importlib
+import io
+import json
 import os
 import shutil
 import sqlite3
 import sys
 import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
 
 import dorm
 
@@ -23,9 +29,21 @@ class Fields(dorm.Table):
     columns = {"email": dorm.Email, "json": dorm.JSON}
 
 
+class Author(dorm.Table):
+    columns = {"name": dorm.String}
+
+
+class Article(dorm.Table):
+    columns = {"title": dorm.String, "author": dorm.ForeignKey(Author)}
+
+
 class TableTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.template, _, _ = dorm.setup(models=[Book, CustomKey, Fields])
+
     def setUp(self):
-        dorm.setup(models=[Book, CustomKey, Fields])
+        dorm.setup(models=[Book, CustomKey, Fields], template=self.template)
 
     def test_lifecycle(self):
         book = Book.insert(name="First Book", year=2019)
@@ -67,6 +85,31 @@ class TableTests(unittest.TestCase):
             [{"name": "1 Scotch"}, {"name": "1 Bourbon"}],
         )
 
+    def test_values_list(self):
+        Book.insert(name="1 Bourbon", year=2020)
+        Book.insert(name="1 Beer", year=2021)
+        self.assertEqual(
+            Book.query().order("name").values_list("name", "year"),
+            [("1 Beer", 2021), ("1 Bourbon", 2020)],
+        )
+        self.assertEqual(
+            Book.query().order("name").values_list("year", flat=True), [2021, 2020]
+        )
+        self.assertEqual(
+            Book.query().values_list(), [(1, "1 Bourbon", 2020), (2, "1 Beer", 2021)]
+        )
+
+    def test_columns(self):
+        Book.insert(name="1 Bourbon", year=2020)
+        Book.insert(name="1 Beer", year=2021)
+        columns = Book.query().order("name").columns("name", "year")
+        self.assertEqual(columns["name"], ["1 Beer", "1 Bourbon"])
+        self.assertEqual(columns["year"], array.array("q", [2021, 2020]))
+        Book.insert(name="Undated")
+        self.assertEqual(Book.query().columns("year")["year"], [2020, 2021, None])
+        Fields.insert(json=[1, 2])
+        self.assertEqual(Fields.query().columns("json")["json"], [[1, 2]])
+
     def test_custom_pk(self):
         obj = CustomKey.insert(pk=13, label="Lucky 13")
         self.assertEqual(obj.pk, obj.key)
@@ -96,6 +139,170 @@ class TableTests(unittest.TestCase):
         self.assertEqual(obj.json, {})
 
 
+class RelationTests(unittest.TestCase):
+    def setUp(self):
+        self.connection, _, _ = dorm.setup(models=[Author, Article])
+
+    def test_schema(self):
+        sql = self.connection.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'article'"
+        ).fetchone()[0]
+        self.assertIn("author integer REFERENCES author", sql)
+        self.assertTrue(
+            self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'article_author_idx'"
+            ).fetchone()
+        )
+
+    def test_prefetch(self):
+        dan = Author.insert(name="Dan")
+        alexa = Author.insert(name="Alexa")
+        Article.insert(title="First", author=dan)
+        Article.insert(title="Second", author=alexa.pk)
+        Article.insert(title="Third", author=dan)
+        Article.insert(title="Anonymous")
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        articles = list(Article.query().order("title").prefetch("author"))
+        self.assertEqual(
+            [a.related("author") and a.related("author").name for a in articles],
+            [None, "Dan", "Alexa", "Dan"],
+        )
+        self.assertEqual(len(statements), 2)
+        with self.assertRaises(dorm.DatabaseError):
+            Article.query().prefetch("title")
+
+    def test_related(self):
+        dan = Author.insert(name="Dan")
+        alexa = Author.insert(name="Alexa")
+        article = Article.insert(title="First", author=dan.pk)
+        self.assertEqual(article.related("author").name, "Dan")
+        article.author = alexa.pk
+        self.assertEqual(article.save().refresh().related("author").name, "Alexa")
+
+
+class DumpLoadTests(unittest.TestCase):
+    def setUp(self):
+        self.connection, _, _ = dorm.setup(models=[CustomKey, Fields, Author, Article])
+
+    def roundtrip(self, table, format, **kwargs):
+        f = io.StringIO()
+        dumped = dorm.dump(table, f, format=format, batch_size=2)
+        table.raw("DELETE FROM {}".format(table.__table__))
+        f.seek(0)
+        loaded = dorm.load(table, f, format=format, batch_size=2, **kwargs)
+        self.assertEqual(loaded, dumped)
+        return f.getvalue()
+
+    def test_jsonl(self):
+        CustomKey.insert(pk=13, label="Lucky 13", data=bytes(range(256)))
+        CustomKey.insert(pk=14, label="Unlucky 14")
+        Fields.insert(email="Dan.Watson@example.COM", json={"hello": [1, 2]})
+        Fields.insert(json=None)
+        self.roundtrip(CustomKey, "jsonl")
+        self.assertEqual(CustomKey.query(pk=13).get("data"), bytes(range(256)))
+        self.assertIsNone(CustomKey.query(pk=14).get("data"))
+        dumped = self.roundtrip(Fields, "jsonl")
+        self.assertIn('"json": {"hello": [1, 2]}', dumped)
+        self.assertEqual(
+            Fields.query().values("email", "json"),
+            [
+                {"email": "dan.watson@example.com", "json": {"hello": [1, 2]}},
+                {"email": "", "json": None},
+            ],
+        )
+
+    def test_csv(self):
+        CustomKey.insert(pk=13, label="Lucky 13", data=bytes(range(256)))
+        CustomKey.insert(pk=14, label="")
+        self.roundtrip(CustomKey, "csv")
+        self.assertEqual(
+            CustomKey.query().values_list(),
+            [(13, "Lucky 13", bytes(range(256))), (14, "", None)],
+        )
+
+    def test_unknown_fields(self):
+        f = io.StringIO('{"key": 1, "label": "One"}\n{"key": 2, "lable": "Two"}\n')
+        with self.assertRaises(dorm.DatabaseError):
+            dorm.load(CustomKey, f)
+        self.assertEqual(CustomKey.query().count(), 0)
+        f = io.StringIO("key,label) VALUES (1, 2); --\n1,One\n")
+        with self.assertRaises(dorm.DatabaseError):
+            dorm.load(CustomKey, f, format="csv")
+        self.assertEqual(CustomKey.query().count(), 0)
+
+    def test_drop_indexes(self):
+        dan = Author.insert(name="Dan")
+        for i in range(5):
+            Article.insert(title="Article {}".format(i), author=dan)
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.roundtrip(Article, "jsonl", drop_indexes=True)
+        self.assertIn("DROP INDEX article_author_idx", statements)
+        self.assertEqual(Article.query(author=dan).count(), 5)
+        self.assertEqual(
+            len(dorm.schema_sql(self.connection, "article", types=("index",))), 1
+        )
+
+
+def book_summary(book):
+    return "{} ({})".format(book.name, book.year)
+
+
+class ParallelTests(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_parallel.db"
+        dorm.setup(self.db_path, models=[Book])
+        for i in range(50):
+            Book.insert(pk=i * 3 + 1, name="Book {}".format(i), year=2000 + i % 5)
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def test_parallel_map(self):
+        expected = [book_summary(book) for book in Book.query()]
+        self.assertEqual(
+            list(Book.query().parallel_map(book_summary, workers=2, chunk_rows=7)),
+            expected,
+        )
+        unordered = Book.query().parallel_map(
+            book_summary, workers=2, chunk_rows=7, ordered=False
+        )
+        self.assertEqual(sorted(unordered), sorted(expected))
+        self.assertEqual(
+            list(
+                Book.query(year=2001).limit(3).parallel_map(book_summary, chunk_rows=2)
+            ),
+            ["Book 1 (2001)", "Book 6 (2001)", "Book 11 (2001)"],
+        )
+        # Misuse fails when parallel_map is called, not when it is first iterated.
+        with self.assertRaises(dorm.DatabaseError):
+            Book.query().order("-year").limit(3).parallel_map(book_summary)
+        with self.assertRaises(dorm.DatabaseError):
+            Book.query().limit(3).parallel_map(book_summary, ordered=False)
+
+    def test_in_flight(self):
+        submitted = []
+
+        class Executor(ThreadPoolExecutor):
+            def submit(self, *args, **kwargs):
+                submitted.append(args)
+                return super().submit(*args, **kwargs)
+
+        with mock.patch.object(dorm, "ProcessPoolExecutor", Executor):
+            results = Book.query().parallel_map(book_summary, workers=1, chunk_rows=1)
+            self.assertEqual(next(results), "Book 0 (2000)")
+            self.assertEqual(len(submitted), 2)
+            self.assertEqual(next(results), "Book 1 (2001)")
+            self.assertEqual(len(submitted), 3)
+            results.close()
+
+    def test_memory(self):
+        dorm.setup(models=[Book])
+        with self.assertRaises(dorm.DatabaseError):
+            Book.query().parallel_map(book_summary)
+
+
 class MigrationTests(unittest.TestCase):
     def setUp(self):
         self.db_path = "test.db"
@@ -107,7 +314,9 @@ class MigrationTests(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.migration_dir)
         os.remove(self.db_path)
-        del sys.modules["test_migrations"]
+        for name in list(sys.modules):
+            if name.split(".")[0] == "test_migrations":
+                del sys.modules[name]
 
     def test_generate(self):
         # Generate the migrations (but they aren't run until next setup).
@@ -133,6 +342,331 @@ class MigrationTests(unittest.TestCase):
         self.assertEqual(Book.query(year=2019).get("author"), "Dan Watson")
         del Book.columns["author"]
 
+    def write_migration(self, name, body):
+        with open(os.path.join(self.migration_dir, name + ".py"), "w") as f:
+            f.write("def forward(connection):\n")
+            for line in body:
+                f.write("    {}\n".format(line))
+
+    def test_atomic(self):
+        self.write_migration("0001", ['connection.execute("CREATE TABLE a (x)")'])
+        self.write_migration(
+            "0002", ['connection.execute("CREATE TABLE b (x)")', "raise ValueError()"]
+        )
+        dorm.setup(self.db_path, models=[dorm.Migration])
+        with self.assertRaises(ValueError):
+            dorm.setup(self.db_path, migrations="test_migrations")
+        names = dorm.Migration.query().values("name", lists=True, flat=True)
+        self.assertEqual(names, ["0001"])
+        tables = dorm.Migration.raw(
+            "SELECT name FROM sqlite_master WHERE name IN ('a', 'b')", fetch=True
+        )
+        self.assertEqual([row["name"] for row in tables], ["a"])
+
+    def test_committed(self):
+        self.write_migration(
+            "0001", ['connection.executescript("CREATE TABLE a (x);")']
+        )
+        self.write_migration("0002", ['connection.execute("CREATE TABLE b (x)")'])
+        dorm.setup(self.db_path, models=[dorm.Migration])
+        with self.assertLogs("dorm", "WARNING"):
+            connection, _, module = dorm.setup(
+                self.db_path, migrations="test_migrations", migrate=False
+            )
+            dorm.Migration.migrate(module, connection, batch=True)
+        names = dorm.Migration.query().values("name", lists=True, flat=True)
+        self.assertEqual(names, ["0001", "0002"])
+        self.assertFalse(connection.in_transaction)
+        self.write_migration("0003", ["connection.commit()"])
+        importlib.invalidate_caches()
+        with self.assertLogs("dorm", "WARNING"):
+            dorm.setup(self.db_path, migrations="test_migrations")
+        self.assertEqual(dorm.Migration.query().count(), 3)
+
+    def test_out_of_order(self):
+        self.write_migration("0002", ['connection.execute("CREATE TABLE b (x)")'])
+        dorm.setup(self.db_path, models=[dorm.Migration])
+        dorm.setup(self.db_path, migrations="test_migrations")
+        self.write_migration("0001", ['connection.execute("CREATE TABLE a (x)")'])
+        importlib.invalidate_caches()
+        with self.assertLogs("dorm", "WARNING") as logs:
+            dorm.setup(self.db_path, migrations="test_migrations")
+        self.assertIn("older than the latest applied migration", logs.output[0])
+        names = dorm.Migration.query().values("name", lists=True, flat=True)
+        self.assertEqual(sorted(names), ["0001", "0002"])
+
+
+class Gadget(dorm.Table):
+    columns = {"name": dorm.String, "weight": dorm.Column("text")}
+
+
+class Price(dorm.Table):
+    columns = {
+        "amount": dorm.Column("decimal(10, 2)"),
+        "currency": dorm.Column("text not null"),
+        "label": dorm.Column("varchar(20)", null=False, default="''"),
+    }
+
+
+class RebuildTests(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_rebuild.db"
+        self.columns = Gadget.columns.copy()
+
+    def tearDown(self):
+        Gadget.columns = self.columns
+        os.remove(self.db_path)
+
+    def test_unchanged(self):
+        dorm.setup(self.db_path, models=[Price])
+        Price.insert(amount=9.99, currency="USD")
+        self.assertEqual(list(Price.schema_changes()), [])
+        with mock.patch.object(dorm.Rebuild, "__call__") as rebuild:
+            dorm.setup(self.db_path, models=[Price])
+            rebuild.assert_not_called()
+        self.assertEqual(Price.query().count(), 1)
+
+    def test_rebuild(self):
+        connection, _, _ = dorm.setup(self.db_path, models=[Gadget])
+        connection.execute("CREATE INDEX gadget_name ON gadget (name)")
+        for i in range(25):
+            Gadget.insert(pk=i * 10 + 1, name="Gadget {}".format(i), weight="1.5")
+        Gadget.columns["weight"] = dorm.Column("real", null=False, default=0)
+        statements = list(Gadget.schema_changes())
+        self.assertEqual(len(statements), 1)
+        self.assertIsInstance(statements[0], dorm.Rebuild)
+        statements[0].batch_size = 10
+        statements[0](connection)
+        self.assertEqual(Gadget.query().count(), 25)
+        self.assertEqual(Gadget.query(pk=241).get("weight"), 1.5)
+        self.assertEqual(Gadget.insert(name="Gadget").refresh().weight, 0)
+        self.assertEqual(list(Gadget.schema_changes()), [])
+        self.assertTrue(
+            connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'gadget_name'"
+            ).fetchone()
+        )
+
+
+class SchemaCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.db_path = "test_cache.db"
+
+    def tearDown(self):
+        os.remove(self.db_path)
+
+    def test_cache_schema(self):
+        connection, _, _ = dorm.setup(self.db_path, models=[Book], cache_schema=True)
+        fingerprint = connection.execute("pragma user_version").fetchone()[0]
+        self.assertEqual(fingerprint, dorm.schema_fingerprint([Book]))
+        connection.close()
+        with mock.patch.object(Book, "schema_changes") as schema_changes:
+            dorm.setup(self.db_path, models=[Book], cache_schema=True)
+            schema_changes.assert_not_called()
+        # Changing the declared schema invalidates the fingerprint.
+        Book.columns["author"] = dorm.String
+        try:
+            connection, _, _ = dorm.setup(
+                self.db_path, models=[Book], cache_schema=True
+            )
+            Book.insert(name="Test Book", year=2019, author="Dan Watson")
+            self.assertNotEqual(
+                connection.execute("pragma user_version").fetchone()[0], fingerprint
+            )
+        finally:
+            del Book.columns["author"]
+
+
+class Score(dorm.ShardedTable):
+    __shard_key__ = "player"
+    __shards__ = ["test_shard0.db", "test_shard1.db", "test_shard2.db"]
+
+    columns = {
+        "player": dorm.Integer,
+        "game": dorm.String(searchable=True),
+        "points": dorm.Integer,
+    }
+
+
+class Highlight(dorm.Table):
+    columns = {"score": dorm.ForeignKey(Score)}
+
+
+class ShardTests(unittest.TestCase):
+    def setUp(self):
+        dorm.setup(models=[Score, Highlight])
+        for player in range(6):
+            for game in ("chess", "go"):
+                Score.insert(player=player, game=game, points=player * 10)
+
+    def tearDown(self):
+        for connection in Score.connections:
+            connection.close()
+        for path in Score.__shards__:
+            os.remove(path)
+
+    def test_routing(self):
+        self.assertEqual(
+            [
+                c.execute("SELECT count(*) FROM score").fetchone()[0]
+                for c in Score.connections
+            ],
+            [4, 4, 4],
+        )
+        self.assertEqual(Score.query(player=4).count(), 2)
+        self.assertEqual(Score.query().count(), 12)
+        score = Score.query(player=4, game="go").get()
+        score.points = 99
+        score.save()
+        self.assertEqual(score.refresh().points, 99)
+        score.player = 2
+        score.points = 0
+        with self.assertRaises(dorm.DatabaseError):
+            score.save()
+        self.assertEqual(score.refresh().player, 4)
+        self.assertEqual(score.points, 99)
+        self.assertEqual(Score.query(player=1).update(points=0), 2)
+        with self.assertRaises(dorm.DatabaseError):
+            Score.insert(game="chess")
+
+    def test_pk(self):
+        pks = Score.query().values_list("rowid", flat=True)
+        self.assertEqual(sorted(pks), list(range(1, 13)))
+        a = Score.insert(player=0, game="shogi")
+        b = Score.insert(player=1, game="shogi")
+        self.assertNotEqual(a.pk, b.pk)
+        statements = []
+        for connection in Score.connections:
+            connection.set_trace_callback(statements.append)
+        self.assertEqual(Score.query(pk=b.pk).get(strict=True).player, 1)
+        self.assertEqual(Score.query(pk=a.pk).get(strict=True).player, 0)
+        self.assertEqual(len(statements), 2)
+        with self.assertRaises(dorm.DatabaseError):
+            Score.insert(pk=a.pk + 1, player=0, game="go")
+
+    def test_search(self):
+        with self.assertRaises(dorm.DatabaseError):
+            Score.query().search("chess")
+        with self.assertRaises(dorm.DatabaseError):
+            Score.query(player=1).search("chess")
+
+    def test_prefetch(self):
+        for score in Score.query(game="go"):
+            Highlight.insert(score=score)
+        highlights = Highlight.query().prefetch("score")
+        self.assertEqual(
+            sorted(h.related("score").player for h in highlights), list(range(6))
+        )
+
+    def test_pk_shard_key(self):
+        class Entry(dorm.ShardedTable):
+            __shard_key__ = "id"
+            __shards__ = ["test_shard0.db"]
+
+            columns = {"id": dorm.PK}
+
+        with self.assertRaises(dorm.DatabaseError):
+            dorm.setup(models=[Entry])
+
+    def test_cache_schema(self):
+        dorm.setup(models=[Score], cache_schema=True)
+        fingerprint = dorm.schema_fingerprint([Score])
+        for connection in Score.connections:
+            version = connection.execute("pragma user_version").fetchone()[0]
+            self.assertEqual(version, fingerprint)
+        with mock.patch.object(Score, "schema_changes") as schema_changes:
+            dorm.setup(models=[Score], cache_schema=True)
+            schema_changes.assert_not_called()
+            dorm.setup(models=[Score])
+            self.assertEqual(schema_changes.call_count, 3)
+
+    def test_dump(self):
+        f = io.StringIO()
+        self.assertEqual(dorm.dump(Score, f), 12)
+        f.seek(0)
+        self.assertEqual(
+            sorted(json.loads(line)["rowid"] for line in f), list(range(1, 13))
+        )
+        f.seek(0)
+        with self.assertRaises(dorm.DatabaseError):
+            dorm.load(Score, f)
+        self.assertEqual(Score.query().count(), 12)
+
+    def test_merge(self):
+        self.assertEqual(
+            Score.query(game="go")
+            .order("-points")
+            .limit(4)
+            .values("player", lists=True, flat=True),
+            [5, 4, 3, 2],
+        )
+        self.assertEqual(
+            Score.query()
+            .order("game", "-player")
+            .limit(3)
+            .values_list("game", "player"),
+            [("chess", 5), ("chess", 4), ("chess", 3)],
+        )
+        self.assertEqual(
+            [s.player for s in Score.query(game="chess").order("points")],
+            list(range(6)),
+        )
+        self.assertEqual(
+            sorted(Score.query().columns("points")["points"]),
+            sorted(p * 10 for p in range(6) for _ in range(2)),
+        )
+
+
+class TemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.migration_dir = os.path.join(os.path.dirname(__file__), "test_migrations")
+        os.makedirs(self.migration_dir, exist_ok=True)
+        with open(os.path.join(self.migration_dir, "__init__.py"), "w") as f:
+            f.write("\n")
+        dorm.generate(*dorm.setup(models=[Post], migrations="test_migrations"))
+        importlib.invalidate_caches()
+
+    def tearDown(self):
+        shutil.rmtree(self.migration_dir)
+        for name in list(sys.modules):
+            if name.split(".")[0] == "test_migrations":
+                del sys.modules[name]
+        if os.path.exists("test_template.db"):
+            os.remove("test_template.db")
+
+    def test_template(self):
+        template, _, _ = dorm.setup(models=[Post], migrations="test_migrations")
+        Post.insert(title="Template post")
+        with mock.patch.object(dorm.Migration, "migrate") as migrate:
+            for path in (":memory:", "test_template.db"):
+                connection, _, _ = dorm.setup(
+                    path, models=[Post], migrations="test_migrations", template=template
+                )
+                self.assertEqual(Post.query().search("template").count(), 1)
+                Post.insert(title="Another post")
+                self.assertEqual(dorm.Migration.query().count(), 1)
+            migrate.assert_not_called()
+        self.assertEqual(template.execute("SELECT count(*) FROM post").fetchone()[0], 1)
+        # Templates can also be database files.
+        connection.close()
+        dorm.setup(models=[Post], template="test_template.db")
+        self.assertEqual(Post.query().search("post").count(), 2)
+        with self.assertRaises(dorm.DatabaseError):
+            dorm.setup(models=[Post], template="missing_template.db")
+        self.assertFalse(os.path.exists("missing_template.db"))
+
+    def test_copy(self):
+        # Connection.backup is missing on Python 3.6.
+        template, _, _ = dorm.setup(models=[Post], migrations="test_migrations")
+        Post.insert(title="Template post")
+        template.execute("pragma user_version = 42")
+        source = mock.Mock(wraps=template, spec=["execute"])
+        connection, _, _ = dorm.setup(models=[Post], template=source)
+        self.assertEqual(connection.execute("pragma user_version").fetchone()[0], 42)
+        self.assertEqual(Post.query().search("template").get().pk, 1)
+        self.assertEqual(Post.insert(title="Another post").pk, 2)
+        self.assertEqual(Post.query().search("post").count(), 2)
+
 
 class Person(dorm.Table):
     pass
@@ -238,11 +772,149 @@ class AsyncTableTests(unittest.TestCase):
             [{"name": "1 Scotch"}, {"name": "1 Bourbon"}],
         )
 
+    @async_test
+    async def test_values_list(self):
+        await AsyncBook.insert(name="1 Bourbon", year=2020)
+        await AsyncBook.insert(name="1 Beer", year=2021)
+        self.assertEqual(
+            await AsyncBook.query().order("name").values_list("name", "year"),
+            [("1 Beer", 2021), ("1 Bourbon", 2020)],
+        )
+        columns = await AsyncBook.query().order("name").columns("year")
+        self.assertEqual(columns["year"], array.array("q", [2021, 2020]))
+
     @async_test
     async def test_custom_pk(self):
         obj = await AsyncCustomKey.insert(pk=13, label="Lucky 13")
         self.assertEqual(obj.pk, obj.key)
 
 
+class GroupCommitTests(unittest.TestCase):
+    def setUp(self):
+        self.connection, _, _ = dorm.setup(models=[AsyncBook, AsyncCustomKey])
+        AsyncBook.writer = AsyncCustomKey.writer = dorm.GroupCommit(batch_size=10)
+
+    def tearDown(self):
+        AsyncBook.writer = AsyncCustomKey.writer = None
+
+    @async_test
+    async def test_group_commit(self):
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        books = await asyncio.gather(
+            *[AsyncBook.insert(name="Book {}".format(i), year=2019) for i in range(25)]
+        )
+        self.assertEqual(sorted(b.pk for b in books), list(range(1, 26)))
+        self.assertEqual(statements.count("SAVEPOINT dorm_group_commit"), 3)
+        self.assertEqual(await AsyncBook.query(year=2019).update(year=2020), 25)
+        self.assertEqual(await AsyncBook.query(year=2020).count(), 25)
+
+    @async_test
+    async def test_errors(self):
+        results = await asyncio.gather(
+            AsyncCustomKey.insert(pk=1, label="One"),
+            AsyncCustomKey.insert(pk=1, label="Uno"),
+            AsyncCustomKey.insert(pk=2, label="Two"),
+            return_exceptions=True,
+        )
+        self.assertEqual(results[0].label, "One")
+        self.assertIsInstance(results[1], sqlite3.IntegrityError)
+        self.assertEqual(results[2].label, "Two")
+        self.assertEqual(await AsyncCustomKey.query().count(), 2)
+
+    @async_test
+    async def test_rollback(self):
+        # Errors like RAISE(ROLLBACK) abort the whole transaction, not just the failed statement.
+        self.connection.execute(
+            "CREATE TRIGGER async_custom_key_bad BEFORE INSERT ON async_custom_key "
+            "WHEN new.label = 'Bad' BEGIN SELECT RAISE(ROLLBACK, 'bad label'); END"
+        )
+        results = await asyncio.gather(
+            AsyncCustomKey.insert(pk=1, label="One"),
+            AsyncCustomKey.insert(pk=2, label="Bad"),
+            AsyncCustomKey.insert(pk=3, label="Three"),
+            return_exceptions=True,
+        )
+        self.assertIsInstance(results[0], sqlite3.IntegrityError)
+        self.assertIs(results[0], results[1])
+        self.assertEqual(results[2].label, "Three")
+        self.assertEqual(
+            await AsyncCustomKey.query().values_list("label", flat=True), ["Three"]
+        )
+
+
+class Post(dorm.Table):
+    columns = {
+        "title": dorm.String(searchable=True),
+        "body": dorm.String(searchable=True),
+        "views": dorm.Integer,
+    }
+
+
+class AsyncPost(dorm.AsyncTable):
+    columns = {"title": dorm.String(searchable=True)}
+
+
+class SearchTests(unittest.TestCase):
+    def setUp(self):
+        dorm.setup(models=[Post, AsyncPost])
+        Post.insert(
+            title="SQLite tips",
+            body="Use SQLite indexes, and FTS5 for search.",
+            views=5,
+        )
+        Post.insert(title="Python tips", body="SQLite is built in.", views=10)
+        Post.insert(title="Cooking", body="Nothing to see here.", views=1)
+
+    def test_search(self):
+        self.assertEqual(
+            [p.title for p in Post.query().search("sqlite")],
+            ["SQLite tips", "Python tips"],
+        )
+        self.assertEqual(Post.query().search("tips").count(), 2)
+        self.assertEqual(
+            Post.query(views=10).search("tips").values("title", lists=True, flat=True),
+            ["Python tips"],
+        )
+        self.assertEqual(
+            Post.query().search("tips").order("-views").values_list("title", flat=True),
+            ["Python tips", "SQLite tips"],
+        )
+        self.assertIsNone(Post.query().search("missing").get())
+        with self.assertRaises(dorm.DatabaseError):
+            Post.query().search("tips", highlight="views")
+
+    def test_highlight(self):
+        post = (
+            Post.query()
+            .search("fts5", highlight="body", snippet="body", tags=("[", "]"), tokens=3)
+            .get()
+        )
+        self.assertEqual(
+            post.body_highlight, "Use SQLite indexes, and [FTS5] for search."
+        )
+        self.assertEqual(post.body_snippet, "...and [FTS5] for...")
+        self.assertLess(post.search_rank, 0)
+
+    def test_sync(self):
+        post = Post.query().search("cooking").get()
+        post.title = "Baking"
+        post.save()
+        self.assertIsNone(Post.query().search("cooking").get())
+        self.assertEqual(Post.query().search("baking").get("views"), 1)
+        self.assertEqual(Post.query().search("baking").update(views=2), 1)
+        self.assertEqual(Post.query(pk=post.pk).get("views"), 2)
+        Post.raw("DELETE FROM post WHERE rowid = ?", [post.pk])
+        self.assertEqual(Post.query().search("baking").count(), 0)
+
+    @async_test
+    async def test_async(self):
+        await AsyncPost.insert(title="Async search")
+        self.assertEqual(
+            await AsyncPost.query().search("search").values("title"),
+            [{"title": "Async search"}],
+        )
+
+
 if __name__ == "__main__":
     unittest.main()